@@ -4,12 +4,13 @@ Make UKIs using objcopy.
 """
 
 from pathlib import Path
+import functools
+import os
 import sys
 import argparse
 import platform
 import re
-import tempfile
-import subprocess
+import struct
 
 # This script requires Python 3.9.
 
@@ -43,6 +44,9 @@ import subprocess
 __version__ = "2"
 
 
+# cached: batch callers re-guess the same arch over and over,
+# and each guess is a stat() per candidate path.
+@functools.lru_cache(maxsize=None)
 def guess_efistub(arch):
     """
     Guess the path of a suitable EFI stub.
@@ -50,14 +54,14 @@ def guess_efistub(arch):
     arch = translate_machine(arch)
 
     guesslist = [
-        Path(f"./linux{arch}.efi.stub"),
-        Path(f"/usr/lib/systemd/boot/efi/linux{arch}.efi.stub"),
-        Path(f"/usr/lib/gummiboot/linux{arch}.efi.stub"),
+        f"./linux{arch}.efi.stub",
+        f"/usr/lib/systemd/boot/efi/linux{arch}.efi.stub",
+        f"/usr/lib/gummiboot/linux{arch}.efi.stub",
     ]
 
     for p in guesslist:
-        if p.exists():
-            return p
+        if os.path.isfile(p):
+            return Path(p)
 
     sys.exit(f"""The EFI stub linux{arch}.efi.stub (required to produce a UKI)
 is absent, and no candidate exists in the filesystem.
@@ -76,63 +80,225 @@ Void: systemd-boot-efistub
 You may also specify -e/--efistub to skip autodetection.""")
 
 
+# architecture mapping taken from efi-mkuki.
+# the exact names live in one dict; only i?86 and arm*
+# need patterns, compiled once.
+_ARCH_EXACT = {
+    "x86_64": "x64",
+    "x64": "x64",
+    "amd64": "x64",
+    "ia32": "ia32",
+    "arm64": "aa64",
+    "aarch64": "aa64",
+    "aa64": "aa64",
+}
+_I386_RE = re.compile(R"i[3-7]86")
+_ARM_RE = re.compile(R"arm.*")
+
+
+@functools.lru_cache(maxsize=None)
 def translate_machine(arch):
     """
     Maps an architecture description into the names used by
     systemd-boot's/gummiboot's EFI stubs.
     """
-    # architecture mapping taken from efi-mkuki.
-    if arch in ("x86_64", "x64", "amd64"):
-        return "x64"
-    if re.search(R"i[34567]86", arch) or arch == "ia32":
+    exact = _ARCH_EXACT.get(arch)
+    if exact is not None:
+        return exact
+    if _I386_RE.fullmatch(arch):
         return "ia32"
-    if arch in ("arm64", "aarch64", "aa64"):
-        return "aa64"
-    if re.search(R"arm.*", arch):
+    if _ARM_RE.match(arch):
         return "arm"
     sys.exit(f"Unknown architecture {arch}. Specify -e/--efistub.")
 
 
-def parse_last_section(efistub) -> int:
+# an IMAGE_SECTION_HEADER: name, virtual size, virtual address,
+# raw size, raw offset, three unused relocation fields, characteristics.
+_SECTION_HEADER = struct.Struct("<8sIIIIIIHHI")
+
+# IMAGE_SCN_CNT_INITIALIZED_DATA | IMAGE_SCN_MEM_READ
+_SECTION_CHARACTERISTICS = 0x40000040
+
+
+def parse_pe_header(data):
+    """
+    Parses the PE/COFF headers of an EFI stub into the
+    handful of fields ukiki cares about, or None if the
+    data isn't a PE file at all.
+    """
+    # the PE header lives at the offset stored in e_lfanew.
+    pe_off = int.from_bytes(data[0x3C:0x40], "little")
+    if data[pe_off : pe_off + 4] != b"PE\0\0":
+        return None
+
+    numsec = int.from_bytes(data[pe_off + 6 : pe_off + 8], "little")
+    opthdr_off = pe_off + 24
+    opthdr_size = int.from_bytes(data[pe_off + 20 : pe_off + 22], "little")
+
+    return {
+        "pe_off": pe_off,
+        "numsec": numsec,
+        "opthdr_off": opthdr_off,
+        # the section table sits right after the
+        # 24-byte COFF header plus the optional header.
+        "sectable_off": opthdr_off + opthdr_size,
+        "size_of_headers": int.from_bytes(
+            data[opthdr_off + 60 : opthdr_off + 64], "little"
+        ),
+        "section_alignment": int.from_bytes(
+            data[opthdr_off + 32 : opthdr_off + 36], "little"
+        ),
+        "file_alignment": int.from_bytes(
+            data[opthdr_off + 36 : opthdr_off + 40], "little"
+        ),
+    }
+
+
+def parse_last_section(data, header) -> int:
     """
-    Runs objdump on an EFI stub to find the
-    virtual load address of its final section.
+    Searches a parsed PE section table for the end of the
+    final (.reloc) section in memory.
     """
-    output = subprocess.check_output(["objdump", "--section-headers", efistub])
-    lastsection = "\n".join(output.decode("UTF-8").split("\n")[-3:])
-    line = re.search(
-        r"(?P<index>\d+)\s+(?P<name>\.\w+)\s+(?P<size>[0-f]+)\s+(?P<vma>[0-f]+)\s+(?P<lma>[0-f]+)\s+(?P<foffset>[0-f]+)\s+(?P<align>2\*\*\d)\n\s+(?P<attributes>[\w, ]+)", lastsection
-    ).group("lma")
+    for i in range(header["numsec"]):
+        sec_off = header["sectable_off"] + i * 40
+        name = data[sec_off : sec_off + 8].rstrip(b"\0")
+        if name == b".reloc":
+            vsize, vaddr = struct.unpack_from("<II", data, sec_off + 8)
+            return vaddr + vsize
 
-    out = int(line, 16)
-    return out
+    sys.exit("the EFI stub has no .reloc section; is it really an EFI stub?")
 
 
-def round_up(value, roundby):
+def copy_range(src_fd, dst_fd, dst_offset, length):
+    """
+    Copies length bytes from the start of src_fd into dst_fd
+    at dst_offset, in-kernel where the OS allows it.
+    """
+    src_offset = 0
+    while length > 0:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+        except (AttributeError, OSError):
+            # e.g. pre-3.8 Python or a filesystem that refuses;
+            # fall back to copying through userspace, capped so a
+            # huge section doesn't land in memory in one piece.
+            n = os.pwrite(
+                dst_fd, os.pread(src_fd, min(length, 1 << 26), src_offset), dst_offset
+            )
+        if n == 0:
+            sys.exit(f"unexpected end of file copying into offset 0x{dst_offset:x}")
+        src_offset += n
+        dst_offset += n
+        length -= n
+
+
+def add_sections(data, header, output, offsets, sizes):
+    """
+    Produces the output UKI directly: copies the EFI stub,
+    splices each section's file in at an aligned offset, and
+    appends matching entries to the PE section table in-place.
+
+    Returns False if the stub's headers have no room left for
+    the new entries; the caller should then fall back to objcopy,
+    which can rewrite the stub's layout.
+    """
+    # raw data is placed by FileAlignment; memory layout
+    # (VMAs, SizeOfImage) goes by SectionAlignment.
+    file_alignment = header["file_alignment"]
+    section_alignment = header["section_alignment"]
+
+    # the new table entries must fit inside the stub's header
+    # region, or they'd overwrite the first section's data.
+    table_end = header["sectable_off"] + (header["numsec"] + len(offsets)) * 40
+    if table_end > header["size_of_headers"]:
+        return False
+
+    dst = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+    try:
+        os.pwrite(dst, data, 0)
+
+        new = []
+        end = round_up(len(data), file_alignment)
+        for k, (vma, p) in offsets.items():
+            size, _ = sizes[k]
+            src = os.open(p, os.O_RDONLY)
+            try:
+                copy_range(src, dst, end, size)
+            finally:
+                os.close(src)
+            new.append((k, vma, size, end))
+            end = round_up(end + size, file_alignment)
+
+        # pad out to the raw size of the final section.
+        os.ftruncate(dst, end)
+
+        table = b"".join(
+            _SECTION_HEADER.pack(
+                k.encode("UTF-8"),
+                size,
+                vma,
+                round_up(size, file_alignment),
+                raw,
+                0,
+                0,
+                0,
+                0,
+                _SECTION_CHARACTERISTICS,
+            )
+            for k, vma, size, raw in new
+        )
+        os.pwrite(dst, table, header["sectable_off"] + header["numsec"] * 40)
+        os.pwrite(
+            dst,
+            struct.pack("<H", header["numsec"] + len(new)),
+            header["pe_off"] + 6,
+        )
+
+        # SizeOfImage must cover the new sections in memory.
+        _, last_vma, last_size, _ = new[-1]
+        os.pwrite(
+            dst,
+            struct.pack("<I", round_up(last_vma + last_size, section_alignment)),
+            header["opthdr_off"] + 56,
+        )
+    finally:
+        os.close(dst)
+    return True
+
+
+def prefetch(file):
     """
-    Rounds up a value by roundby, then adds another roundby.
+    Hints the kernel to start reading a file into the
+    page cache, so objcopy doesn't wait on cold disks.
     """
-    return -(-value // roundby) * roundby + roundby
+    # not all platforms have posix_fadvise; it's only a hint anyway.
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
 
 
-def calculate_size(file, alignment) -> int:
+def round_up(value, roundby):
     """
-    Calculates the size of a file,
-    rounded upwards to alignment.
+    Rounds up a value to a multiple of roundby.
+    roundby must be a power of two.
     """
-    return round_up(file.stat().st_size, alignment), file
+    return (value + roundby - 1) & -roundby
 
 
-def running_total(sizes, start):
+def running_total(sizes, start, alignment):
     """
-    Converts a dict of section sizes
-    to offsets given a starting offset.
+    Converts a dict of raw section sizes to offsets
+    given a starting offset, aligning each section start.
     """
     last = start
     ret = {}
     for k, (v, p) in sizes.items():
         ret[k] = last, p
-        last = v + last
+        last = round_up(last + v, alignment)
     return ret
 
 
@@ -160,66 +326,121 @@ def main():
         default=platform.machine(),
     )
     parser.add_argument(
-        "-u", "--ucode", help="path to microcode initramfs"
+        "-u", "--ucode", help="path to microcode initramfs", type=Path
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="print section sizes and offsets", action="store_true"
     )
 
     args = parser.parse_args()
 
+    # deferred past parse_args so --help doesn't pay for them;
+    # only the fallback paths below use them at all.
+    import subprocess
+    import tempfile
+
     # use args.efistub as first priority, else guess the efistub.
     efistub = args.efistub if args.efistub is not None else guess_efistub(args.arch)
 
-    with tempfile.NamedTemporaryFile() as cmdline:
-        cmdline.write(f"{args.cmdline}".encode("UTF-8"))
-        cmdline.seek(0)
-
-        last_stub_section = parse_last_section(efistub)
-        # close enough.
-        # it's safer to use an overly wide alignment
-        # than to have used an overly narrow alignment
-        alignment = 0x1000
+    # the cmdline has to live in a file. a memfd never touches
+    # disk at all; failing that, a temporary file next to the
+    # output keeps it on the same filesystem as the output.
+    # skipped entirely when there's no cmdline to embed.
+    cmdline_fd = None
+    cmdline_tmp = None
+    cmdline_path = None
+    if args.cmdline != "":
+        if hasattr(os, "memfd_create"):
+            cmdline_fd = os.memfd_create("cmdline")
+            os.write(cmdline_fd, f"{args.cmdline}".encode("UTF-8"))
+            cmdline_path = Path(f"/proc/self/fd/{cmdline_fd}")
+        else:
+            cmdline_tmp = tempfile.NamedTemporaryFile(dir=args.output.parent)
+            cmdline_tmp.write(f"{args.cmdline}".encode("UTF-8"))
+            cmdline_tmp.flush()
+            cmdline_path = Path(cmdline_tmp.name)
+
+    try:
+        try:
+            stub_data = Path(efistub).read_bytes()
+        except FileNotFoundError:
+            sys.exit(f"EFI stub {efistub} does not exist")
+        stub_header = parse_pe_header(stub_data)
+        if stub_header is None:
+            sys.exit(f"{efistub} is not a PE file; is it really an EFI stub?")
+
+        last_stub_section = parse_last_section(stub_data, stub_header)
+        # lay sections out by the stub's own declared
+        # SectionAlignment rather than assuming a page.
+        alignment = stub_header["section_alignment"]
+        # round_up's bitwise trick only works on powers of two.
+        assert alignment & (alignment - 1) == 0
 
         aligned_stub_section = round_up(last_stub_section, alignment)
 
-        print(f"final stub section is at 0x{last_stub_section:x}")
-        print(f"next section will be at 0x{aligned_stub_section:x}")
+        if args.verbose:
+            print(f"final stub section ends at 0x{last_stub_section:x}")
+            print(f"next section will be at 0x{aligned_stub_section:x}")
 
         # dicts are ordered in Python 3.7+.
-        sizes = {}
-        sizes[".osrel"] = calculate_size(args.osrel, alignment)
-        sizes[".initrd"] = calculate_size(args.initrd, alignment)
+        files = {}
+        files[".osrel"] = args.osrel
+        files[".initrd"] = args.initrd
 
         if args.ucode is not None:
-            sizes[".ucode"] = calculate_size(args.ucode, alignment)
+            files[".ucode"] = args.ucode
         if args.splash is not None:
-            sizes[".splash"] = calculate_size(args.splash, alignment)
+            files[".splash"] = args.splash
         if args.cmdline != "":
-            sizes[".cmdline"] = calculate_size(Path(cmdline.name), alignment)
-        sizes[".linux"] = calculate_size(args.linux, alignment)
-
-        print("sizes:")
-        for k, (v, p) in sizes.items():
-            print(f"{k}: 0x{v:x} at {p}")
-
-        offsets = running_total(sizes, aligned_stub_section)
-
-        print("offsets:")
-        for k, (v, p) in offsets.items():
-            print(f"{k}: 0x{v:x} at {p}")
-
-        command_line = ["objcopy", str(efistub), str(args.output)]
-
-        append = []
-        for k, (v, p) in offsets.items():
-            append += [
-                "--add-section",
-                f"{k}={p}",
-                "--change-section-vma",
-                f"{k}=0x{v:x}",
-            ]
-
-        command_line += append
-
-        subprocess.run(command_line, check=False)
+            files[".cmdline"] = cmdline_path
+        files[".linux"] = args.linux
+
+        # stat everything up front: a missing input fails here
+        # with a clear message, before any output is written.
+        try:
+            sizes = {k: (p.stat().st_size, p) for k, p in files.items()}
+        except FileNotFoundError as e:
+            sys.exit(f"input file {e.filename} does not exist")
+
+        if args.verbose:
+            print("sizes:")
+            for k, (v, p) in sizes.items():
+                print(f"{k}: 0x{v:x} at {p}")
+
+        offsets = running_total(sizes, aligned_stub_section, alignment)
+
+        if args.verbose:
+            print("offsets:")
+            for k, (v, p) in offsets.items():
+                print(f"{k}: 0x{v:x} at {p}")
+
+        # the stub itself is already in memory by now.
+        for _, (_, p) in offsets.items():
+            prefetch(p)
+
+        if not add_sections(stub_data, stub_header, args.output, offsets, sizes):
+            # no room left in the stub's header for more section
+            # table entries; let objcopy rewrite the layout instead.
+            command_line = ["objcopy", str(efistub), str(args.output)]
+            for k, (v, p) in offsets.items():
+                command_line.extend(
+                    (
+                        "--add-section",
+                        f"{k}={p}",
+                        "--change-section-vma",
+                        f"{k}=0x{v:x}",
+                    )
+                )
+
+            # /proc/self/fd/N only resolves inside objcopy if it
+            # inherits the memfd under the same number.
+            pass_fds = (cmdline_fd,) if cmdline_fd is not None else ()
+            subprocess.run(command_line, check=False, pass_fds=pass_fds)
+    finally:
+        if cmdline_fd is not None:
+            os.close(cmdline_fd)
+        elif cmdline_tmp is not None:
+            cmdline_tmp.close()
 
 
 if __name__ == "__main__":